@@ -1,19 +1,23 @@
 #!/usr/bin/env python
 '''A simple Wi-Fi connection optimizer based on the geolocation.'''
 
+import asyncio
 import binascii
+from collections.abc import AsyncIterable
+import csv
+from functools import lru_cache
 import logging
 import os
 from pathlib import Path
 import re
 import subprocess
 import sys
-from threading import Event
+from threading import Event, Thread
 from time import sleep
 from typing import NoReturn
+from zipfile import BadZipFile
 
 import numpy as np
-import pandas as pd
 import sdbus
 try:
     # Base class of EVERY error sdbus can raise: mapped NetworkManager errors,
@@ -27,8 +31,10 @@ except ImportError:  # pragma: no cover - depends on sdbus version
     from sdbus.dbus_exceptions import SdBusBaseError
 from sdbus import (
     DbusInterfaceCommon,
+    DbusInterfaceCommonAsync,
     dbus_method,
     dbus_property,
+    dbus_signal_async,
 )
 from sdbus_block.networkmanager import (
     AccessPoint,
@@ -49,20 +55,64 @@ profile_pattern = re.compile(
     r'^(/[0-9a-zA-Z-]+)+/[1-9][0-9]*-kiss-enable-[0-9a-zA-Z]+.nmconnection$'
 )
 
+DMI_PRODUCT_UUID_PATH = '/sys/class/dmi/id/product_uuid'
+
 
 def _halt() -> NoReturn:
     Event().wait(timeout=None)
     return sys.exit(0)
 
 
+@lru_cache(maxsize=1)
 def _get_system_uuid() -> str:
+    '''Read the SMBIOS system UUID, in the upper case as dmidecode prints it.
+
+    Prefer the kernel's sysfs copy; only fork `dmidecode` if it's unreadable.
+    '''
+    try:
+        return Path(DMI_PRODUCT_UUID_PATH).read_text('ascii').strip().upper()
+    except OSError:
+        pass
     outputs = subprocess.check_output(
         args=['dmidecode', '-s', 'system-uuid'],
         shell=False,
         stdin=None,
         stderr=sys.stderr,
     )
-    return outputs.decode('utf-8').strip()
+    return outputs.decode('utf-8').strip().upper()
+
+
+def _list_profile_connections() -> tuple[
+    list[str],
+    list[NetworkConnectionSettings],
+]:
+    '''List the connections whose keyfile matches `profile_pattern`.'''
+    connection_paths = list(NetworkManagerSettings().connections)
+    connections = [
+        NetworkConnectionSettings(path)
+        for path in connection_paths
+    ]
+    # Each property read is a D-Bus round-trip; read every filename only once.
+    filenames = [
+        connection.filename
+        for connection in connections
+    ]
+    matched_indices = [
+        index
+        for index, filename in enumerate(filenames)
+        if profile_pattern.match(filename)
+    ]
+    logger.debug('Found connection profiles: %s', repr([
+        filenames[index]
+        for index in matched_indices
+    ]))
+    return [
+        connection_paths[index]
+        for index in matched_indices
+    ], [
+        connections[index]
+        for index in matched_indices
+    ]
 
 
 def _find_device(
@@ -86,21 +136,10 @@ def _find_device(
     primary_connection_uuid = profile.connection.uuid
 
     logger.info('List all wifi interfaces')
-    settings = NetworkManagerSettings()
-    connection_paths = list(settings.connections)
-    connections = [
-        NetworkConnectionSettings(path)
-        for path in connection_paths
-    ]
-    print([
-        connection.filename
-        for connection in connections
-        if profile_pattern.match(connection.filename)
-    ])
+    connection_paths, connections = _list_profile_connections()
     profiles = [
         connection.get_profile()
         for connection in connections
-        if profile_pattern.match(connection.filename)
     ]
     wifi_indices = [
         index
@@ -155,77 +194,285 @@ def _find_device(
     return connection_path, connection, profile, device_path, device
 
 
-def _find_bssids(
+def _request_scan(
     device: NetworkDeviceWireless,
     ssid: bytes,
-) -> tuple[list[str], dict[str, str]]:
+) -> None:
     logger.debug('Rescan APs')
     device.request_scan(
         options={
             'ssids': ('aay', [ssid]),
         },
     )
-    ap_paths = list(device.access_points)
-    aps = [
-        (path, AccessPoint(path))
-        for path in ap_paths
-    ]
-    aps = [
-        (path, ap)
-        for path, ap in aps
-        if ap.ssid == ssid
-    ]
-    max_bitrate = max(
-        ap.max_bitrate
-        for _, ap in aps
-    )
+
+
+def _find_bssids(
+    device: NetworkDeviceWireless,
+    ssid: bytes,
+) -> tuple[list[str], dict[str, str]]:
+    _request_scan(device, ssid)
+    # Fetch each AP's properties with one GetAll D-Bus round-trip.
+    max_bitrate = -1
+    bssids: list[str] = []
     # Map the normalized BSSID to its AP object path so that activation
     # can pin the exact AP via `specific_object` (instead of letting
     # NetworkManager pick/generate one).
-    bssid_to_ap_path = {
-        ap.hw_address.upper(): path
-        for path, ap in aps
-    }
-    bssids = [
-        ap.hw_address
-        for _, ap in aps
-        if ap.max_bitrate == max_bitrate
-    ]
+    bssid_to_ap_path: dict[str, str] = {}
+    for path in device.access_points:
+        properties = AccessPoint(path).properties_get_all_dict(
+            on_unknown_member='ignore',
+        )
+        if properties['ssid'] != ssid:
+            continue
+        bitrate: int = properties['max_bitrate']
+        bssid: str = properties['hw_address']
+        bssid_to_ap_path[bssid.upper()] = path
+        if bitrate > max_bitrate:
+            max_bitrate = bitrate
+            bssids = [bssid]
+        elif bitrate == max_bitrate:
+            bssids.append(bssid)
+    if not bssids:
+        raise ValueError(f'No APs found: {ssid!r}')
     return bssids, bssid_to_ap_path
 
 
+NM_SERVICE_NAME = 'org.freedesktop.NetworkManager'
+
+
+class _NmWirelessSignals(
+    DbusInterfaceCommonAsync,
+    interface_name='org.freedesktop.NetworkManager.Device.Wireless',
+):
+    '''Minimal async proxy for the AP signals of a NM Wi-Fi device.
+
+    `sdbus_async.networkmanager` clashes with `sdbus_block.networkmanager`
+    (both register the same D-Bus error names), so it can't be imported.
+    '''
+
+    @dbus_signal_async('o', signal_name='AccessPointAdded')
+    def access_point_added(self) -> str:
+        raise NotImplementedError
+
+    @dbus_signal_async('o', signal_name='AccessPointRemoved')
+    def access_point_removed(self) -> str:
+        raise NotImplementedError
+
+
+class _AccessPointWatcher:
+    '''Track whether NetworkManager reported any AP change since last asked.
+
+    The blocking sdbus API cannot receive signals, so a daemon thread runs a
+    private asyncio loop on its own system bus connection and listens to the
+    device's AccessPointAdded/AccessPointRemoved signals. If subscribing
+    fails, every check reports a change, i.e. plain polling.
+    '''
+
+    def __init__(self, device_path: str) -> None:
+        self._changed = Event()
+        self._changed.set()  # nothing is known yet
+        self._watching = True
+        Thread(
+            target=self._run,
+            args=(device_path,),
+            name='ap-watcher',
+            daemon=True,
+        ).start()
+
+    def pop_changed(self) -> bool:
+        '''Whether the APs (may) have changed since the previous call.'''
+        if self._changed.is_set():
+            self._changed.clear()
+            return True
+        return not self._watching
+
+    def mark_changed(self) -> None:
+        '''Re-arm a popped change that could not be acted upon.'''
+        self._changed.set()
+
+    def _run(self, device_path: str) -> None:
+        try:
+            asyncio.run(self._watch(device_path))
+        except (SdBusBaseError, OSError) as error:
+            logger.warning(
+                'Failed to watch APs (%s); falling back to polling', error,
+            )
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception('AP watcher crashed; falling back to polling')
+        finally:
+            self._watching = False
+
+    async def _watch(self, device_path: str) -> None:
+        device = _NmWirelessSignals.new_proxy(
+            NM_SERVICE_NAME, device_path, sdbus.sd_bus_open_system(),
+        )
+        await asyncio.gather(
+            self._forward(device.access_point_added),
+            self._forward(device.access_point_removed),
+        )
+
+    async def _forward(self, signal: AsyncIterable[str]) -> None:
+        async for ap_path in signal:
+            logger.debug('APs changed: %s', ap_path)
+            self._changed.set()
+
+
+def _mac_to_bytes(mac: str) -> bytes:
+    return bytes.fromhex(mac.replace(':', ''))
+
+
+def _macs_to_array(macs: list[str]) -> np.ndarray:
+    '''Decode all MACs at once into a (N, 6) array.'''
+    hexes = [mac.replace(':', '') for mac in macs]
+    malformed = [mac for mac, digits in zip(macs, hexes) if len(digits) != 12]
+    if malformed:
+        raise ValueError(f'Malformed MAC addresses: {malformed!r}')
+    buffer = bytes.fromhex(''.join(hexes))
+    return np.frombuffer(buffer, dtype=np.uint8).reshape(-1, 6)
+
+
+def _read_table(path: Path) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''Read the `id`, `x` and `y` columns of a geolocation table.'''
+    # 'utf-8-sig' drops the BOM of spreadsheet exports, as pandas did.
+    with open(path, newline='', encoding='utf-8-sig') as file:
+        rows = list(csv.DictReader(file))
+    ids = np.array([row['id'] for row in rows], dtype=str)
+    xs = np.fromiter((float(row['x']) for row in rows), np.float64, len(rows))
+    ys = np.fromiter((float(row['y']) for row in rows), np.float64, len(rows))
+    return ids, xs, ys
+
+
+# Bump whenever the meaning or validation of the cached fields changes.
+GEOLOCATION_CACHE_VERSION = 1
+GEOLOCATION_FIELDS = (
+    'src_ids', 'src_x', 'src_y',
+    'tgt_ids', 'tgt_macs', 'tgt_x', 'tgt_y',
+)
+
+
+def _read_geolocations(
+    sources_path: Path,
+    targets_path: Path,
+) -> dict[str, np.ndarray]:
+    '''Parse the sources/targets tables into plain arrays.'''
+    src_ids, src_x, src_y = _read_table(sources_path)
+    tgt_ids, tgt_x, tgt_y = _read_table(targets_path)
+    return {
+        'src_ids': src_ids,
+        'src_x': src_x,
+        'src_y': src_y,
+        'tgt_ids': tgt_ids,
+        'tgt_macs': _macs_to_array(tgt_ids.tolist()),
+        'tgt_x': tgt_x,
+        'tgt_y': tgt_y,
+    }
+
+
+def _load_geolocations(
+    sources_path: Path,
+    targets_path: Path,
+    cache_file: str | None,
+) -> dict[str, np.ndarray]:
+    '''Load the geolocations, reusing the on-disk cache while it is fresh.
+
+    The cache is a plain `.npz` archive (no pickle) keyed by its format
+    version and the mtime and size of both tables.
+    '''
+    if cache_file is None:
+        return _read_geolocations(sources_path, targets_path)
+    cache_path = Path(cache_file)
+
+    stats = [sources_path.stat(), targets_path.stat()]
+    key = np.array([GEOLOCATION_CACHE_VERSION] + [
+        value
+        for stat in stats
+        for value in (stat.st_mtime_ns, stat.st_size)
+    ], dtype=np.int64)
+
+    try:
+        # An empty file raises EOFError; a plain `.npy` array is no archive.
+        cache = np.load(cache_path)
+        if not isinstance(cache, np.lib.npyio.NpzFile):
+            raise ValueError(f'Not an .npz archive: {cache_path}')
+        with cache:
+            if np.array_equal(cache['key'], key) and all(
+                name in cache.files
+                for name in GEOLOCATION_FIELDS
+            ):
+                logger.debug('Reuse the cached geolocations')
+                return {
+                    name: cache[name]
+                    for name in GEOLOCATION_FIELDS
+                }
+    except (BadZipFile, EOFError, KeyError, OSError, ValueError) as error:
+        logger.debug('Skip the geolocation cache: %s', error)
+
+    geolocations = _read_geolocations(sources_path, targets_path)
+    # Write aside and rename, so that a crash never leaves a torn cache.
+    partial_path = cache_path.with_name(f'.{cache_path.name}.partial')
+    try:
+        with open(partial_path, 'wb') as file:
+            np.savez(
+                file,
+                key=key,
+                src_ids=geolocations['src_ids'],
+                src_x=geolocations['src_x'],
+                src_y=geolocations['src_y'],
+                tgt_ids=geolocations['tgt_ids'],
+                tgt_macs=geolocations['tgt_macs'],
+                tgt_x=geolocations['tgt_x'],
+                tgt_y=geolocations['tgt_y'],
+            )
+        os.replace(partial_path, cache_path)
+    except OSError as error:
+        # Caching is best-effort; just never leave the partial file behind.
+        logger.debug('Failed to write the geolocation cache: %s', error)
+        partial_path.unlink(missing_ok=True)
+    return geolocations
+
+
 class _AccessPointSelector:
     def __init__(
         self,
-        sources: pd.DataFrame,
-        targets: pd.DataFrame,
+        geolocations: dict[str, np.ndarray],
     ) -> None:
-        self._sources = sources
-        self._targets = targets
-
         system_uuid = _get_system_uuid()
-        index_source = self._sources['id'] == system_uuid
-        if not index_source.any():  # type: ignore
+        index_source = np.flatnonzero(
+            np.char.upper(geolocations['src_ids']) == system_uuid,
+        )
+        if not index_source.size:
             logger.warning('Unsupported node: %s', system_uuid)
             _halt()
 
-        source = self._sources[index_source]
-        logger.info('Node info\n%s', repr(source))
-        self._x: float = source['x'].item()
-        self._y: float = source['y'].item()
+        self._x: float = geolocations['src_x'][index_source[0]].item()
+        self._y: float = geolocations['src_y'][index_source[0]].item()
+        logger.info(
+            'Node info: %s (x=%s, y=%s)', system_uuid, self._x, self._y,
+        )
 
-    def _fit_target(self, bssid: str) -> int | None:
-        macs = [
-            binascii.unhexlify(mac.replace(':', ''))  # type: ignore
-            for mac in self._targets['id']  # type: ignore
+        self._target_ids = geolocations['tgt_ids']
+        self._target_macs = [
+            mac.tobytes()
+            for mac in geolocations['tgt_macs']
         ]
-        pattern = binascii.unhexlify(bssid.replace(':', ''))
+        # Nothing moves: precompute the squared (same argmin) distances.
+        self._target_distances = \
+            (geolocations['tgt_x'] - self._x) ** 2 + \
+            (geolocations['tgt_y'] - self._y) ** 2
+
+        # A BSSID's middle 4 bytes match its target AP's MAC exactly, so a
+        # lookup only checks the outer bytes of a handful of candidates.
+        self._mid_index: dict[bytes, list[int]] = {}
+        for index, mac in enumerate(self._target_macs):
+            self._mid_index.setdefault(mac[1:-1], []).append(index)
+
+    def _fit_target(self, bssid: str) -> int | None:
+        pattern = _mac_to_bytes(bssid)
         filtered = [
             index
-            for index, mac in enumerate(macs)
-            if pattern[1:-1] == mac[1:-1]
-            if abs(pattern[0] - mac[0]) in [0, 8]
-            if pattern[-1] - mac[-1] >= 0 and pattern[-1] - mac[-1] < 16
+            for index in self._mid_index.get(pattern[1:-1], [])
+            if abs(pattern[0] - self._target_macs[index][0]) in [0, 8]
+            if 0 <= pattern[-1] - self._target_macs[index][-1] < 16
         ]
         if not filtered:
             return None
@@ -240,38 +487,23 @@ class _AccessPointSelector:
         '''Find a best AP's BSSID.'''
 
         # Map to the target APs
-        target_indices = [
-            self._fit_target(bssid)
-            for bssid in bssids
-        ]
-        targets = pd.DataFrame(self._targets.iloc[[
-            index
-            for index in target_indices
-            if index is not None
-        ]])
-        targets = targets.reset_index(inplace=False, drop=True)
-
-        # Concat the BSSIDs into the targets
-        series_bssid = pd.Series([
-            bssid
-            for index, bssid in zip(target_indices, bssids)
-            if index is not None
-        ])
-        targets.loc[:, ['bssid']] = series_bssid
-        logger.debug('Available APs\n%s', repr(targets))
-
-        # Find the nearest AP
-        series_diff_x = (targets['x'] - self._x).abs()  # type: ignore
-        series_diff_y = (targets['y'] - self._y).abs()  # type: ignore
-        series_l2_dist = np.sqrt(
-            series_diff_x ** 2 + series_diff_y ** 2  # type: ignore
-        )
-        if series_l2_dist.empty:
+        target_indices = []
+        found_bssids = []
+        for bssid in bssids:
+            index = self._fit_target(bssid)
+            if index is not None:
+                target_indices.append(index)
+                found_bssids.append(bssid)
+        if not target_indices:
             return None
-        nearest_ap_index = np.argmin(series_l2_dist).item()
+        logger.debug('Available APs: %s', repr([
+            (bssid, self._target_ids[index].item())
+            for bssid, index in zip(found_bssids, target_indices)
+        ]))
 
-        # Return the nearest AP's BSSID
-        return targets['bssid'][nearest_ap_index]  # type: ignore
+        # Find the nearest AP
+        distances = self._target_distances[target_indices]
+        return found_bssids[int(np.argmin(distances))]
 
 
 def _persist_profile(
@@ -496,7 +728,7 @@ class _NmBackend(_Backend):
     def apply(self, bssid: str | None, ap_path: str) -> bool:
         if bssid is not None:
             logger.debug('Switch BSSID to: %s', bssid)
-            bssid_bytes = binascii.unhexlify(bssid.replace(':', ''))
+            bssid_bytes = _mac_to_bytes(bssid)
             if self._wireless.bssid == bssid_bytes:
                 return True
             self._wireless.bssid = bssid_bytes
@@ -525,17 +757,16 @@ class _NmBackend(_Backend):
             return False
 
     def is_pinned(self, bssid: str) -> bool:
-        active_connections = []
-        for path in iter(self._nm.active_connections):
-            try:
-                active_connections.append(
-                    ActiveConnection(path).connection
-                )
-            except SdBusBaseError:
-                # The active connection may vanish between listing and reading
-                # it; skip it rather than crash.
-                pass
-        return self._connection_path in active_connections
+        # Ask the device which connection it runs: just two round-trips.
+        try:
+            active_connection_path = self._device.active_connection
+            if active_connection_path == '/':
+                return False
+            return ActiveConnection(active_connection_path).connection == \
+                self._connection_path
+        except SdBusBaseError:
+            # The device or its active connection may vanish meanwhile.
+            return False
 
 
 class _WpaBackend(_Backend):
@@ -617,33 +848,82 @@ class _WpaBackend(_Backend):
         return _normalize_mac_bytes(raw)
 
 
+def _scan_candidates(
+    device: NetworkDeviceWireless,
+    ssid: bytes,
+    watcher: _AccessPointWatcher,
+    pinned: bool,
+    last_bssids: frozenset[str],
+) -> tuple[list[str], dict[str, str]] | None:
+    '''Scan the BSSIDs to select from, or None to keep the current pin.
+
+    While the radio is pinned, re-selecting is pointless if no AP came or
+    went, or if the candidates are the same as last time (e.g. only APs of
+    other SSIDs changed).
+    '''
+    changed = watcher.pop_changed()
+    try:
+        if pinned and not changed:
+            _request_scan(device, ssid)  # so that NM notices (and signals)
+            return None
+        bssids, bssid_to_ap_path = _find_bssids(device, ssid)
+    except (SdBusBaseError, ValueError) as error:
+        # Scan failed or no AP of the SSID: retry, keeping the change.
+        logger.warning('Failed to scan APs: %s', error)
+        if changed:
+            watcher.mark_changed()
+        return None
+    logger.debug('Detected BSSIDs: %s', repr(bssids))
+
+    if pinned and frozenset(bssids) == last_bssids:
+        return None
+    return bssids, bssid_to_ap_path
+
+
+def _deprioritize() -> None:
+    '''Keep this mostly-sleeping daemon out of the way of co-tenant jobs.
+
+    Run on the first allowed CPU at the lowest priority. On Linux this only
+    covers this thread and later ones, hence the single-threaded BLAS image.
+    '''
+    try:
+        os.sched_setaffinity(0, {min(os.sched_getaffinity(0))})
+    except (AttributeError, OSError) as error:  # non-Linux / not permitted
+        logger.debug('Failed to set the CPU affinity: %s', error)
+    try:
+        os.nice(19)
+    except (AttributeError, OSError) as error:
+        logger.debug('Failed to lower the nice value: %s', error)
+    try:
+        os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+    except (AttributeError, OSError) as error:
+        logger.debug('Failed to set the idle scheduling policy: %s', error)
+
+
 def _main() -> None:
     nm = NetworkManager()
     connection_path, connection, profile, device_path, device = \
         _find_device(nm)
 
     logger.info('Load geolocational informations')
-    selector = _AccessPointSelector(
-        sources=pd.read_csv(  # type: ignore
-            Path(os.environ.get('SRC_FILE', 'sources.csv'))
-        ),
-        targets=pd.read_csv(  # type: ignore
-            Path(os.environ.get('TGT_FILE', 'targets.csv'))
-        ),
-    )
+    selector = _AccessPointSelector(_load_geolocations(
+        sources_path=Path(os.environ.get('SRC_FILE', 'sources.csv')),
+        targets_path=Path(os.environ.get('TGT_FILE', 'targets.csv')),
+        cache_file=os.environ.get('CACHE_FILE') or None,
+    ))
 
     wireless: WirelessSettings = profile.wireless  # type: ignore
 
     ssid: bytes = wireless.ssid  # type: ignore
-    ssid_str = ssid.decode('utf-8')
-    logger.info('Find BSSIDs: %s', ssid_str)
+    logger.info('Find BSSIDs: %s', ssid.decode('utf-8'))
 
     dry_run = os.environ.get('DRY_RUN', 'false') == 'true'
     interval_secs = float(os.environ.get('INTERVAL_SECS', '30'))
     one_shot = os.environ.get('ONE_SHOT', 'false') == 'true'
-    backend_name = os.environ.get('BACKEND', 'nm').lower()
 
-    if backend_name in ('wpa', 'wpa_supplicant', 'supplicant'):
+    if os.environ.get('BACKEND', 'nm').lower() in (
+        'wpa', 'wpa_supplicant', 'supplicant',
+    ):
         logger.info('Backend: wpa_supplicant (D-Bus)')
         backend: _Backend = _WpaBackend(device.interface, dry_run)
     else:
@@ -659,22 +939,25 @@ def _main() -> None:
         )
 
     backend.startup()
+    watcher = _AccessPointWatcher(device_path)
 
     last_bssid = None
+    last_bssids: frozenset[str] = frozenset()
     while True:
         # If the link dropped, bring it back without an NM restart.
         backend.recover()
 
-        try:
-            bssids, bssid_to_ap_path = _find_bssids(device, ssid)
-        except (SdBusBaseError, ValueError) as error:
-            # SdBusBaseError: scan/AP enumeration failed (device down, bus
-            # busy). ValueError: max() over zero matching APs. Either way,
-            # back off and retry next interval instead of crashing.
-            logger.warning('Failed to scan APs: %s', error)
+        candidates = _scan_candidates(
+            device, ssid, watcher,
+            last_bssid is not None and backend.is_pinned(last_bssid),
+            last_bssids,
+        )
+        if candidates is None:
+            logger.debug('Skipped re-selecting (BSSID: %s)', last_bssid)
             sleep(interval_secs)
             continue
-        logger.debug('Detected BSSIDs: %s', repr(bssids))
+        bssids, bssid_to_ap_path = candidates
+        last_bssids = frozenset(bssids)
 
         # Select and apply the best BSSID.
         bssid = selector.find(bssids)
@@ -707,6 +990,9 @@ if __name__ == '__main__':
         level = logging.INFO  # pylint: disable=C0103
     logging.basicConfig(level=level)
 
+    # Run in the background of the node
+    _deprioritize()
+
     # Use system D-Bus
     sdbus.set_default_bus(sdbus.sd_bus_open_system())
 